@@ -1,12 +1,20 @@
 """
-MistOrgLicensingComparison - Flask Web Application
+MistOrgLicensingComparison - Quart Web Application
 
 Compares licensing information across multiple Juniper Mist organizations.
 """
 
 import os
+import gzip
+import time
+import random
+import asyncio
 import logging
-from flask import Flask, render_template, jsonify, request
+from concurrent.futures import ThreadPoolExecutor
+import brotli
+import orjson
+from quart import Quart, Response, current_app, render_template, jsonify, request, g
+from quart.json.provider import JSONProvider
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -20,35 +28,216 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
 
-# Global Mist connection (lazy initialization)
-_mist_connection = None
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson, used by jsonify() and request.get_json()"""
+    
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Build the body straight from orjson bytes, skipping the str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+
+# Max organizations fetched concurrently by /api/compare (respects Mist rate limits)
+COMPARE_CONCURRENCY = int(os.environ.get('COMPARE_CONCURRENCY', 16))
+_compare_semaphore = asyncio.Semaphore(COMPARE_CONCURRENCY)
+
+# Background cache prewarming (seconds between runs, 0 disables). Kept below
+# INVENTORY_TTL (15 min), the shortest prewarmed TTL, so a pass refreshes each
+# entry before it expires even when the pass itself takes a few minutes
+PREWARM_INTERVAL = int(os.environ.get('PREWARM_INTERVAL', 10 * 60))
+PREWARM_CONCURRENCY = 8
+_prewarm_task = None
 
+# Seconds to wait before retrying a failed Mist connection from a request
+MIST_RETRY_INTERVAL = 10
+_mist_lock = asyncio.Lock()
 
-def get_mist_connection():
-    """Get or create Mist API connection"""
-    global _mist_connection
+# Response compression for JSON and HTML bodies
+COMPRESS_MIMETYPES = {'application/json', 'text/html'}
+COMPRESS_MIN_SIZE = 500
+
+
+def create_mist_connection():
+    """Create the Mist API connection from environment variables"""
+    from mist_connection import MistConnection
     
-    if _mist_connection is None:
-        from mist_connection import MistConnection
-        
-        api_token = os.environ.get('MIST_API_TOKEN') or os.environ.get('MIST_APITOKEN')
-        if not api_token:
-            raise ValueError("MIST_API_TOKEN environment variable is required")
-        
-        org_id = os.environ.get('MIST_ORG_ID')
-        host = os.environ.get('MIST_HOST', 'api.mist.com')
-        
-        _mist_connection = MistConnection(api_token=api_token, org_id=org_id, host=host)
+    api_token = os.environ.get('MIST_API_TOKEN') or os.environ.get('MIST_APITOKEN')
+    if not api_token:
+        raise ValueError("MIST_API_TOKEN environment variable is required")
+    
+    org_id = os.environ.get('MIST_ORG_ID')
+    host = os.environ.get('MIST_HOST', 'api.mist.com')
+    
+    return MistConnection(api_token=api_token, org_id=org_id, host=host)
+
+
+async def connect_mist():
+    """Create the Mist connection, recording the error if it fails"""
+    try:
+        mist = await asyncio.to_thread(create_mist_connection)
+    except Exception as e:
+        # Keep serving (health checks, UI) and report the cause from API endpoints
+        logger.error("Error initializing Mist connection: %s", e)
+        app.extensions['mist_error'] = str(e)
+        app.extensions['mist_failed_at'] = time.monotonic()
+        return None
+    app.extensions.pop('mist_error', None)
+    app.extensions['mist'] = mist
+    return mist
+
+
+async def get_mist_connection():
+    """Get the Mist API connection, retrying creation if startup failed"""
+    mist = current_app.extensions.get('mist')
+    if mist is not None:
+        return mist
+    
+    async with _mist_lock:
+        # Another request may have connected while we waited
+        mist = current_app.extensions.get('mist')
+        if mist is not None:
+            return mist
+        if time.monotonic() - current_app.extensions.get('mist_failed_at', 0) >= MIST_RETRY_INTERVAL:
+            mist = await connect_mist()
+            if mist is not None:
+                start_prewarm_task(mist)
+                return mist
+    raise RuntimeError(current_app.extensions.get('mist_error', 'Mist connection not initialized'))
+
+
+@app.before_serving
+async def configure_executor():
+    """Size the default thread pool for concurrent blocking Mist API calls"""
+    # Each org in /api/compare runs three blocking calls at once
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=COMPARE_CONCURRENCY * 3)
+    )
+
+
+@app.before_serving
+async def init_mist_connection():
+    """Connect to the Mist API once per process, before any request is served"""
+    await connect_mist()
+
+
+async def prewarm_cache(mist) -> None:
+    """Fetch info, licenses and inventory for every accessible org through the cache"""
+    semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+    
+    async def warm(org_id: str):
+        async with semaphore:
+            # Jitter spreads the burst of calls to respect Mist rate limits
+            await asyncio.sleep(random.uniform(0, 0.5))
+            try:
+                await asyncio.gather(
+                    asyncio.to_thread(mist.get_organization_info, org_id),
+                    asyncio.to_thread(mist.get_org_licenses, org_id),
+                    asyncio.to_thread(mist.get_org_inventory_counts, org_id)
+                )
+            except Exception as e:
+                logger.warning("Prewarm failed for org %s: %s", org_id, e)
+    
+    orgs = await asyncio.to_thread(mist.get_organizations)
+    await asyncio.gather(*[warm(org['id']) for org in orgs])
+    logger.info("Prewarmed cache for %s organization(s)", len(orgs))
+
+
+async def prewarm_loop(mist) -> None:
+    """Keep the cache warm for all accessible orgs, refreshing periodically"""
+    while True:
+        try:
+            await prewarm_cache(mist)
+        except Exception as e:
+            logger.warning("Cache prewarm failed: %s", e)
+        await asyncio.sleep(PREWARM_INTERVAL)
+
+
+def start_prewarm_task(mist) -> None:
+    """Start background cache prewarming when a Redis cache is configured"""
+    global _prewarm_task
+    from cache import is_enabled
+    
+    if _prewarm_task is None and PREWARM_INTERVAL > 0 and is_enabled():
+        _prewarm_task = asyncio.create_task(prewarm_loop(mist))
+
+
+@app.before_serving
+async def start_prewarm():
+    """Start prewarming if the Mist connection was created at startup"""
+    mist = app.extensions.get('mist')
+    if mist is not None:
+        start_prewarm_task(mist)
+
+
+@app.after_serving
+async def stop_prewarm():
+    """Cancel background cache prewarming"""
+    if _prewarm_task is not None:
+        _prewarm_task.cancel()
+
+
+@app.after_serving
+async def close_mist_connection():
+    """Release pooled Mist API connections on shutdown"""
+    mist = app.extensions.get('mist')
+    if mist is not None:
+        await asyncio.to_thread(mist.close)
+
+
+@app.before_request
+async def start_stale_tracking():
+    """Record cache entries served stale while handling this request"""
+    from cache import track_stale
+    
+    g.stale_keys = track_stale()
+
+
+@app.after_request
+async def mark_stale_response(response):
+    """Flag responses built from stale cache data after a Mist API failure"""
+    if getattr(g, 'stale_keys', None):
+        response.headers['X-Cache'] = 'STALE'
+    return response
+
+
+@app.after_request
+async def compress_response(response):
+    """Compress JSON/HTML bodies with brotli or gzip when the client accepts it"""
+    if response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers:
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'])
+    if encoding is None:
+        return response
     
-    return _mist_connection
+    data = await response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    if encoding == 'br':
+        # Low quality levels keep per-response CPU cost close to gzip
+        response.set_data(brotli.compress(data, quality=4))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+    return response
 
 
 @app.route('/')
-def index():
+async def index():
     """Render main page"""
-    response = app.make_response(render_template('index.html'))
+    response = await app.make_response(await render_template('index.html'))
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
@@ -56,121 +245,145 @@ def index():
 
 
 @app.route('/health')
-def health():
+async def health():
     """Health check endpoint"""
     return jsonify({'status': 'healthy'}), 200
 
 
 @app.route('/api/organizations')
-def get_organizations():
+async def get_organizations():
     """Get list of accessible organizations"""
     try:
-        mist = get_mist_connection()
-        orgs = mist.get_organizations()
+        mist = await get_mist_connection()
+        orgs = await asyncio.to_thread(mist.get_organizations)
         return jsonify({'success': True, 'data': orgs})
     except Exception as e:
-        logger.error(f"Error getting organizations: {e}")
+        logger.error("Error getting organizations: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/api/organization/<org_id>')
-def get_organization(org_id: str):
+async def get_organization(org_id: str):
     """Get organization details"""
     try:
-        mist = get_mist_connection()
-        org_info = mist.get_organization_info(org_id)
+        mist = await get_mist_connection()
+        org_info = await asyncio.to_thread(mist.get_organization_info, org_id)
         return jsonify({'success': True, 'data': org_info})
     except Exception as e:
-        logger.error(f"Error getting organization {org_id}: {e}")
+        logger.error("Error getting organization %s: %s", org_id, e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/api/licenses/<org_id>')
-def get_licenses(org_id: str):
+async def get_licenses(org_id: str):
     """Get license summary for an organization"""
     try:
-        mist = get_mist_connection()
-        licenses = mist.get_org_licenses(org_id)
+        mist = await get_mist_connection()
+        licenses = await asyncio.to_thread(mist.get_org_licenses, org_id)
         return jsonify({'success': True, 'data': licenses})
     except Exception as e:
-        logger.error(f"Error getting licenses for org {org_id}: {e}")
+        logger.error("Error getting licenses for org %s: %s", org_id, e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/api/license-usage/<org_id>')
-def get_license_usage(org_id: str):
+async def get_license_usage(org_id: str):
     """Get license usage by site for an organization"""
     try:
-        mist = get_mist_connection()
-        usage = mist.get_org_license_usage(org_id)
+        mist = await get_mist_connection()
+        usage = await asyncio.to_thread(mist.get_org_license_usage, org_id)
         return jsonify({'success': True, 'data': usage})
     except Exception as e:
-        logger.error(f"Error getting license usage for org {org_id}: {e}")
+        logger.error("Error getting license usage for org %s: %s", org_id, e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/api/inventory/<org_id>')
-def get_inventory(org_id: str):
+async def get_inventory(org_id: str):
     """Get inventory counts for an organization"""
     try:
-        mist = get_mist_connection()
-        counts = mist.get_org_inventory_counts(org_id)
+        mist = await get_mist_connection()
+        counts = await asyncio.to_thread(mist.get_org_inventory_counts, org_id)
         return jsonify({'success': True, 'data': counts})
     except Exception as e:
-        logger.error(f"Error getting inventory for org {org_id}: {e}")
+        logger.error("Error getting inventory for org %s: %s", org_id, e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/api/compare', methods=['POST'])
-def compare_organizations():
+async def compare_organizations():
     """
     Compare licensing across multiple organizations
     
     Request body: {"org_ids": ["org1", "org2", ...]}
+    
+    Streams one JSON object per organization (NDJSON) as each one completes,
+    in completion order rather than request order. "stale" is true when the
+    org's data came from the cache after a Mist API failure.
     """
     try:
-        data = request.get_json()
+        data = await request.get_json()
         org_ids = data.get('org_ids', [])
         
         if not org_ids:
             return jsonify({'success': False, 'error': 'No organization IDs provided'}), 400
         
-        mist = get_mist_connection()
-        results = []
+        mist = await get_mist_connection()
+        
+        async def fetch_one(org_id: str) -> dict:
+            """Fetch info, licenses and inventory for one org concurrently"""
+            from cache import track_stale
+            
+            # Each task gets its own set, so staleness is reported per org
+            stale_keys = track_stale()
+            async with _compare_semaphore:
+                try:
+                    org_info, licenses, inventory = await asyncio.gather(
+                        asyncio.to_thread(mist.get_organization_info, org_id),
+                        asyncio.to_thread(mist.get_org_licenses, org_id),
+                        asyncio.to_thread(mist.get_org_inventory_counts, org_id)
+                    )
+                    return {
+                        'org_id': org_id,
+                        'org_name': org_info.get('org_name', 'Unknown'),
+                        'licenses': licenses,
+                        'inventory': inventory,
+                        'stale': bool(stale_keys),
+                        'error': None
+                    }
+                except Exception as e:
+                    logger.warning("Error fetching data for org %s: %s", org_id, e)
+                    return {
+                        'org_id': org_id,
+                        'org_name': 'Error',
+                        'licenses': None,
+                        'inventory': None,
+                        'stale': False,
+                        'error': str(e)
+                    }
         
-        for org_id in org_ids:
+        async def generate():
+            tasks = [asyncio.create_task(fetch_one(org_id)) for org_id in org_ids]
             try:
-                org_info = mist.get_organization_info(org_id)
-                licenses = mist.get_org_licenses(org_id)
-                inventory = mist.get_org_inventory_counts(org_id)
-                
-                results.append({
-                    'org_id': org_id,
-                    'org_name': org_info.get('org_name', 'Unknown'),
-                    'licenses': licenses,
-                    'inventory': inventory,
-                    'error': None
-                })
-            except Exception as e:
-                logger.warning(f"Error fetching data for org {org_id}: {e}")
-                results.append({
-                    'org_id': org_id,
-                    'org_name': 'Error',
-                    'licenses': None,
-                    'inventory': None,
-                    'error': str(e)
-                })
+                # Send each org as soon as it resolves instead of waiting for the slowest
+                for next_result in asyncio.as_completed(tasks):
+                    yield orjson.dumps(await next_result) + b'\n'
+            finally:
+                # Client disconnected or stream finished; stop any remaining work
+                for task in tasks:
+                    task.cancel()
         
-        return jsonify({'success': True, 'data': results})
+        return Response(generate(), mimetype='application/x-ndjson')
         
     except Exception as e:
-        logger.error(f"Error comparing organizations: {e}")
+        logger.error("Error comparing organizations: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
 if __name__ == '__main__':
+    # Development server only; production runs under gunicorn with uvicorn workers
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
     
-    logger.info(f"Starting MistOrgLicensingComparison on port {port}")
+    logger.info("Starting MistOrgLicensingComparison on port %s", port)
     app.run(host='0.0.0.0', port=port, debug=debug)
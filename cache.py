@@ -0,0 +1,242 @@
+"""
+Redis Response Cache for MistOrgLicensingComparison
+
+Cache-aside memoization for MistConnection methods. Redis caching is enabled
+when REDIS_URL is set; hot, rarely-changing methods can also opt into a small
+in-process TTL cache checked before Redis. Entries outlive their freshness
+TTL so the last known response can be served if the Mist API is failing.
+"""
+
+import os
+import time
+import logging
+import functools
+import threading
+import weakref
+from contextvars import ContextVar
+from typing import Any, Callable, Optional, Tuple
+import orjson
+import redis
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.environ.get('REDIS_URL')
+
+# Shared client (connection pooled); None when caching is disabled
+_redis: Optional[redis.Redis] = (
+    redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+    if REDIS_URL else None
+)
+
+# How long entries are kept for fallback after they stop being fresh
+STALE_TTL = 24 * 60 * 60
+# After a failed refresh, serve the stale entry without retrying upstream for this long
+REFRESH_FAILURE_TTL = 30
+
+# Keys served stale in the current context (None when not tracking)
+_stale_keys: ContextVar[Optional[set]] = ContextVar('stale_keys', default=None)
+
+# In-process layer in front of Redis (cachetools caches are not thread-safe)
+LOCAL_CACHE_SIZE = 1024
+LOCAL_CACHE_TTL = 60
+_local: TTLCache = TTLCache(maxsize=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL)
+_local_lock = threading.Lock()
+
+
+class _KeyLock:
+    """threading.Lock wrapper that can be held in a WeakValueDictionary"""
+    
+    __slots__ = ('_lock', '__weakref__')
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+    
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+
+# Per-key single-flight locks; entries disappear once no caller holds them
+_key_locks: 'weakref.WeakValueDictionary[str, _KeyLock]' = weakref.WeakValueDictionary()
+_key_locks_guard = threading.Lock()
+
+_MISSING = object()
+
+
+def is_enabled() -> bool:
+    """Return True if a Redis cache is configured"""
+    return _redis is not None
+
+
+def cache_key(func_name: str, host: str, org_id: Optional[str], schema: int = 1) -> str:
+    """Build the Redis key for a cached MistConnection method call"""
+    return f"v2:mist:{func_name}:s{schema}:{host}:{org_id}"
+
+
+def track_stale() -> set:
+    """
+    Start recording keys served stale in the current context.
+
+    The returned set is shared with worker threads started from this context
+    (e.g. via asyncio.to_thread), so it can be inspected after the calls finish.
+    """
+    keys = set()
+    _stale_keys.set(keys)
+    return keys
+
+
+def _key_lock(key: str) -> _KeyLock:
+    """Get the lock serializing cache fills for a key"""
+    with _key_locks_guard:
+        lock = _key_locks.get(key)
+        if lock is None:
+            lock = _key_locks[key] = _KeyLock()
+        return lock
+
+
+def _local_get(key: str) -> Any:
+    """Read a key from the in-process cache (_MISSING if absent)"""
+    with _local_lock:
+        return _local.get(key, _MISSING)
+
+
+def _local_set(key: str, value: Any):
+    """Store a key in the in-process cache"""
+    with _local_lock:
+        _local[key] = value
+
+
+def _serve_stale(key: str, entry: dict) -> Any:
+    """Return a stale entry's data, recording the key as served stale"""
+    stale_keys = _stale_keys.get()
+    if stale_keys is not None:
+        stale_keys.add(key)
+    return entry['data']
+
+
+def _lookup(key: str, ttl: int) -> Tuple[Optional[dict], Optional[Tuple[Any, bool]]]:
+    """
+    Read a key's entry from Redis.
+    
+    Returns:
+        Tuple of (entry, hit). entry is the stored envelope (None if absent or
+        unreadable); hit is (value, is_stale) when the entry can be served
+        without calling the Mist API - it is fresh, or its last refresh failed
+        within REFRESH_FAILURE_TTL - else None
+    """
+    try:
+        raw, refresh_failed = _redis.mget(key, f"{key}:refresh-failed")
+    except redis.RedisError as e:
+        logger.warning("Redis read failed for %s: %s", key, e)
+        return None, None
+    if raw is None:
+        return None, None
+    
+    entry = orjson.loads(raw)
+    if time.time() - entry['fetched_at'] < ttl:
+        return entry, (entry['data'], False)
+    if refresh_failed is not None:
+        return entry, (_serve_stale(key, entry), True)
+    return entry, None
+
+
+def _fetch(key: str, ttl: int, load: Callable[[], Any]) -> Tuple[Any, bool]:
+    """
+    Read through Redis, calling load() and storing the result on a miss.
+
+    Entries are stored as {"fetched_at", "data"} and kept for STALE_TTL. Once
+    older than ttl they are refreshed; if that refresh fails the stale data is
+    returned instead of raising, and further refreshes are skipped for
+    REFRESH_FAILURE_TTL so waiting callers don't each retry the upstream.
+    
+    Returns:
+        Tuple of (value, is_stale)
+    """
+    if _redis is None:
+        return load(), False
+
+    entry, hit = _lookup(key, ttl)
+    if hit is not None:
+        return hit
+
+    try:
+        result = load()
+    except Exception as e:
+        if entry is None:
+            raise
+        logger.warning("Serving stale %s after upstream error: %s", key, e)
+        try:
+            _redis.setex(f"{key}:refresh-failed", REFRESH_FAILURE_TTL, 1)
+        except redis.RedisError as redis_error:
+            logger.warning("Redis write failed for %s: %s", key, redis_error)
+        return _serve_stale(key, entry), True
+
+    try:
+        _redis.setex(key, STALE_TTL, orjson.dumps({'fetched_at': time.time(), 'data': result}))
+    except redis.RedisError as e:
+        logger.warning("Redis write failed for %s: %s", key, e)
+
+    return result, False
+
+
+def cached(ttl: int, local: bool = False, single_flight: bool = False,
+           schema: int = 1) -> Callable:
+    """
+    Cache a MistConnection per-org method in Redis.
+
+    Redis errors are logged and treated as a cache miss so an unavailable
+    cache never fails a request, and stale entries are served if the Mist
+    API call fails.
+
+    Args:
+        ttl: Freshness lifetime for Redis entries in seconds
+        local: Also keep results in the in-process TTL cache (checked first)
+        single_flight: Serialize concurrent misses per key so only one caller
+            hits the Mist API while the rest wait for the cache to fill
+            (always on for local entries)
+        schema: Version of the cached data's shape; bump it when the method's
+            return value changes so old entries are ignored
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(self, org_id: Optional[str] = None) -> Any:
+            target_org = org_id or self.org_id
+            key = cache_key(func.__name__, self.host, target_org, schema)
+            load = functools.partial(func, self, target_org)
+
+            if local:
+                result = _local_get(key)
+                if result is not _MISSING:
+                    return result
+            elif not single_flight or _redis is None:
+                # Nothing for waiters to re-check, so locking would only serialize calls
+                return _fetch(key, ttl, load)[0]
+
+            if _redis is not None:
+                # Lock-free read first so hits never queue behind a refresh
+                _, hit = _lookup(key, ttl)
+                if hit is not None:
+                    result, is_stale = hit
+                    if local and not is_stale:
+                        _local_set(key, result)
+                    return result
+
+            with _key_lock(key):
+                # Another thread may have filled the key while we waited
+                if local:
+                    result = _local_get(key)
+                    if result is not _MISSING:
+                        return result
+
+                # _fetch re-checks Redis before calling the Mist API
+                result, is_stale = _fetch(key, ttl, load)
+                # Stale fallbacks stay out of the local layer so the next call retries
+                if local and not is_stale:
+                    _local_set(key, result)
+                return result
+        return wrapper
+    return decorator
@@ -6,12 +6,138 @@ Supports multiple API tokens, each potentially accessing different organizations
 """
 
 import os
+import time
 import logging
-from typing import Dict, List, Optional, Tuple
+import functools
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import mistapi
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tenacity import (
+    before_sleep_log,
+    retry,
+    retry_if_result,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+
+from cache import cached
 
 logger = logging.getLogger(__name__)
 
+# Cache TTLs (seconds), matched to how often each dataset changes
+ORG_INFO_TTL = 6 * 60 * 60
+LICENSE_TTL = 30 * 60
+INVENTORY_TTL = 15 * 60
+# Mist inventory device types and the keys they are reported under
+INVENTORY_DEVICE_TYPES = {'ap': 'aps', 'switch': 'switches', 'gateway': 'gateways'}
+# Orgs with at most this many devices are counted from a single inventory page
+INVENTORY_PAGE_LIMIT = 1000
+# Bump when project_licenses() changes shape so cached entries are refetched
+LICENSE_SCHEMA = 2
+# Organization list is built from getSelf privileges, which rarely change
+ORGS_TTL = 60 * 60
+
+# Mist responses worth retrying: transient upstream errors. Rate limiting (429)
+# is left to mistapi, which already retries it (3 times as of 0.64) - retrying
+# it here as well would multiply the attempts. Auth failures (401/403) are
+# returned immediately.
+RETRY_STATUS_CODES = (502, 503, 504)
+RETRY_ATTEMPTS = 5
+MAX_RETRY_WAIT = 10
+
+# Shared HTTPS pool sizing: enough keep-alive connections for the parallel
+# /api/compare fan-out so connections are reused instead of re-handshaked
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = int(os.environ.get('MIST_POOL_MAXSIZE', 64))
+
+_backoff = wait_exponential_jitter(initial=0.5, max=MAX_RETRY_WAIT)
+
+
+def _is_transient(response) -> bool:
+    """Check whether a mistapi response should be retried"""
+    status_code = getattr(response, 'status_code', None)
+    # mistapi swallows connection errors and returns a response without a status
+    return status_code is None or status_code in RETRY_STATUS_CODES
+
+
+def _wait_retry_after(retry_state) -> float:
+    """Wait for the server's Retry-After if given, else back off exponentially"""
+    outcome = retry_state.outcome
+    if outcome is not None and not outcome.failed:
+        headers = getattr(outcome.result(), 'headers', None) or {}
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_RETRY_WAIT)
+            except ValueError:
+                pass
+    return _backoff(retry_state)
+
+
+@retry(
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(RETRY_ATTEMPTS),
+    # mistapi catches request exceptions itself, so failures arrive as results
+    retry=retry_if_result(_is_transient),
+    # After the last attempt, hand back the final response
+    retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+)
+def _call_api(api_func, *args, **kwargs):
+    """Call a mistapi endpoint function, retrying transient failures"""
+    return api_func(*args, **kwargs)
+
+
+def _orjson_json(response: requests.Response, **kwargs) -> Any:
+    """Decode a response body with orjson, falling back to requests' decoder"""
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        # Non-UTF-8 or invalid bodies keep requests' behavior and error type
+        return requests.Response.json(response, **kwargs)
+
+
+def _use_orjson_decoder(response: requests.Response, *args, **kwargs) -> requests.Response:
+    """
+    requests response hook: make response.json() (used by mistapi) use orjson.
+    
+    Only the JSON parse is replaced; mistapi's APIResponse still reads
+    response.text, so the body is decoded to str as before.
+    """
+    response.json = functools.partial(_orjson_json, response)
+    return response
+
+
+def project_licenses(data: Dict) -> Dict:
+    """
+    Trim a license summary to the fields the comparison UI uses.
+
+    Args:
+        data: getOrgLicensesSummary response data
+
+    Returns:
+        Dict with entitled and summary counts by license type, and amendments
+    """
+    return {
+        'entitled': data.get('entitled') or {},
+        'summary': data.get('summary') or {},
+        'amendments': [
+            {
+                'type': amendment.get('type'),
+                'quantity': amendment.get('quantity', 0),
+                'start_time': amendment.get('start_time'),
+                'end_time': amendment.get('end_time')
+            }
+            for amendment in data.get('amendments') or []
+        ]
+    }
+
 
 class MistConnection:
     """Handles connections to Mist API for licensing data retrieval.
@@ -36,6 +162,24 @@ class MistConnection:
         self._sessions: List[Tuple[mistapi.APISession, Dict]] = []
         # Map org_id to session for quick lookup
         self._org_to_session: Dict[str, mistapi.APISession] = {}
+        # One HTTPS connection pool shared by every token's session, so
+        # keep-alive connections and TLS handshakes are reused across tokens
+        self._adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_MAXSIZE,
+            # One quick reconnect for dropped keep-alive sockets. Status responses
+            # (incl. Retry-After on 429/503) pass through untouched to mistapi and
+            # _call_api, which own the retry policy, so attempts don't multiply
+            max_retries=Retry(total=1, connect=1, read=1, status=0, backoff_factor=0.3,
+                              respect_retry_after_header=False, raise_on_status=False)
+        )
+        # Memoized get_organizations() result, rebuilt from getSelf after ORGS_TTL
+        self._orgs_cached: Optional[List[Dict]] = None
+        self._orgs_cached_at = 0.0
+        self._orgs_lock = threading.Lock()
+        # Upstream calls currently in flight, keyed so duplicates can share them
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
         
         # Initialize all API sessions
         self._init_sessions(api_token)
@@ -44,7 +188,7 @@ class MistConnection:
         if not self.org_id and self._sessions:
             self._auto_detect_org()
         
-        logger.info(f"Initialized Mist connection to {self.host} with {len(self._sessions)} working token(s)")
+        logger.info("Initialized Mist connection to %s with %s working token(s)", self.host, len(self._sessions))
     
     def _init_sessions(self, api_token: str):
         """Initialize mistapi sessions for all provided tokens"""
@@ -70,29 +214,24 @@ class MistConnection:
                         console_log_level=30,  # WARNING level
                         show_cli_notif=False
                     )
+                    self._configure_http_session(session)
                     
                     # Test the token and get user info
-                    test_response = mistapi.api.v1.self.self.getSelf(session)
+                    test_response = _call_api(mistapi.api.v1.self.self.getSelf, session)
                     
                     if test_response.status_code == 200:
                         self_data = test_response.data
                         self._sessions.append((session, self_data))
+                        self._map_orgs(session, self_data)
                         
-                        # Map each org to this session
-                        if 'privileges' in self_data:
-                            for priv in self_data['privileges']:
-                                org_id = priv.get('org_id')
-                                if org_id and org_id not in self._org_to_session:
-                                    self._org_to_session[org_id] = session
-                        
-                        logger.info(f"Token {idx + 1}/{len(token_list)} initialized successfully")
+                        logger.info("Token %s/%s initialized successfully", idx + 1, len(token_list))
                     elif test_response.status_code == 429:
-                        logger.warning(f"Token {idx + 1} rate limited, skipping...")
+                        logger.warning("Token %s rate limited, skipping...", idx + 1)
                     else:
-                        logger.warning(f"Token {idx + 1} returned {test_response.status_code}")
+                        logger.warning("Token %s returned %s", idx + 1, test_response.status_code)
                         
                 except Exception as e:
-                    logger.warning(f"Token {idx + 1} failed: {e}")
+                    logger.warning("Token %s failed: %s", idx + 1, e)
                     continue
             
             if not self._sessions:
@@ -103,13 +242,60 @@ class MistConnection:
             if saved_token is not None:
                 os.environ['MIST_APITOKEN'] = saved_token
     
+    def _map_orgs(self, session: mistapi.APISession, self_data: Dict):
+        """Map each org in a getSelf response to the session that can access it"""
+        if 'privileges' in self_data:
+            for priv in self_data['privileges']:
+                org_id = priv.get('org_id')
+                if org_id and org_id not in self._org_to_session:
+                    self._org_to_session[org_id] = session
+    
+    def _call_once(self, key: str, call: Callable[[], Any]) -> Any:
+        """Run call() unless one with the same key is in flight, then share its result"""
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._inflight[key] = Future()
+        
+        if not is_owner:
+            return future.result()
+        
+        try:
+            result = call()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+    
+    def _configure_http_session(self, session: mistapi.APISession):
+        """Route a session's HTTP traffic through the shared pool and orjson decoding"""
+        # mistapi keeps its requests.Session in a private attribute; auth headers
+        # stay per-session, only the underlying connections are pooled
+        http_session = getattr(session, '_session', None)
+        if isinstance(http_session, requests.Session):
+            http_session.mount('https://', self._adapter)
+            http_session.hooks['response'].append(_use_orjson_decoder)
+    
+    def close(self):
+        """Close all API sessions and their pooled connections"""
+        for session, _ in self._sessions:
+            http_session = getattr(session, '_session', None)
+            if isinstance(http_session, requests.Session):
+                http_session.close()
+        self._adapter.close()
+    
     def _auto_detect_org(self):
         """Auto-detect organization ID from first available session"""
         if self._sessions:
             session, self_data = self._sessions[0]
             if 'privileges' in self_data and len(self_data['privileges']) > 0:
                 self.org_id = self_data['privileges'][0].get('org_id')
-                logger.info(f"Auto-detected org_id: {self.org_id}")
+                logger.info("Auto-detected org_id: %s", self.org_id)
     
     def _get_session_for_org(self, org_id: str) -> mistapi.APISession:
         """Get the appropriate session for accessing an organization"""
@@ -122,6 +308,36 @@ class MistConnection:
     
     def get_organizations(self) -> List[Dict]:
         """Get list of all organizations accessible from all tokens (deduplicated)"""
+        with self._orgs_lock:
+            if self._orgs_cached is not None and time.monotonic() - self._orgs_cached_at > ORGS_TTL:
+                self._refresh_self_data()
+                self._orgs_cached = None
+            if self._orgs_cached is None:
+                self._orgs_cached = self._build_org_list()
+                self._orgs_cached_at = time.monotonic()
+            return self._orgs_cached
+    
+    def refresh_orgs(self):
+        """Re-fetch getSelf for every token and drop the memoized organization list"""
+        with self._orgs_lock:
+            self._refresh_self_data()
+            self._orgs_cached = None
+    
+    def _refresh_self_data(self):
+        """Update each session's getSelf data, keeping the old data on failure"""
+        for idx, (session, _) in enumerate(self._sessions):
+            try:
+                response = _call_api(mistapi.api.v1.self.self.getSelf, session)
+                if response.status_code == 200:
+                    self._sessions[idx] = (session, response.data)
+                    self._map_orgs(session, response.data)
+                else:
+                    logger.warning("Token %s refresh returned %s", idx + 1, response.status_code)
+            except Exception as e:
+                logger.warning("Token %s refresh failed: %s", idx + 1, e)
+    
+    def _build_org_list(self) -> List[Dict]:
+        """Build the deduplicated, name-sorted organization list from getSelf data"""
         orgs_seen = set()
         orgs = []
         
@@ -143,13 +359,14 @@ class MistConnection:
         orgs.sort(key=lambda x: x['name'].lower())
         return orgs
     
+    @cached(ttl=ORG_INFO_TTL, local=True)
     def get_organization_info(self, org_id: Optional[str] = None) -> Dict:
         """Get organization information"""
         target_org = org_id or self.org_id
         session = self._get_session_for_org(target_org)
         
         try:
-            response = mistapi.api.v1.orgs.orgs.getOrg(session, target_org)
+            response = _call_api(mistapi.api.v1.orgs.orgs.getOrg, session, target_org)
             if response.status_code == 200:
                 data = response.data
                 return {
@@ -161,9 +378,10 @@ class MistConnection:
             else:
                 raise Exception(f"API error: {response.status_code}")
         except Exception as e:
-            logger.error(f"Error getting organization info: {str(e)}")
+            logger.error("Error getting organization info: %s", e)
             raise
     
+    @cached(ttl=LICENSE_TTL, single_flight=True, schema=LICENSE_SCHEMA)
     def get_org_licenses(self, org_id: Optional[str] = None) -> Dict:
         """
         Get organization license information
@@ -172,24 +390,26 @@ class MistConnection:
             org_id: Organization ID (uses default if not provided)
             
         Returns:
-            Dict with license summary and details
+            Dict with entitled/used counts by license type and amendments
         """
         target_org = org_id or self.org_id
         session = self._get_session_for_org(target_org)
         
         try:
-            response = mistapi.api.v1.orgs.licenses.getOrgLicensesSummary(
+            response = _call_api(
+                mistapi.api.v1.orgs.licenses.getOrgLicensesSummary,
                 session, target_org
             )
             
             if response.status_code == 200:
-                return response.data
+                return project_licenses(response.data)
             else:
                 raise Exception(f"API error: {response.status_code}")
         except Exception as e:
-            logger.error(f"Error getting licenses for org {target_org}: {str(e)}")
+            logger.error("Error getting licenses for org %s: %s", target_org, e)
             raise
     
+    @cached(ttl=LICENSE_TTL)
     def get_org_license_usage(self, org_id: Optional[str] = None) -> Dict:
         """
         Get organization license usage details
@@ -204,7 +424,8 @@ class MistConnection:
         session = self._get_session_for_org(target_org)
         
         try:
-            response = mistapi.api.v1.orgs.licenses.getOrgLicensesBySite(
+            response = _call_api(
+                mistapi.api.v1.orgs.licenses.getOrgLicensesBySite,
                 session, target_org
             )
             
@@ -213,9 +434,83 @@ class MistConnection:
             else:
                 raise Exception(f"API error: {response.status_code}")
         except Exception as e:
-            logger.error(f"Error getting license usage for org {target_org}: {str(e)}")
+            logger.error("Error getting license usage for org %s: %s", target_org, e)
             raise
     
+    def _count_inventory_listing(self, session: mistapi.APISession, target_org: str) -> Optional[Counter]:
+        """
+        Count devices by type from a single getOrgInventory page
+        
+        Returns:
+            Counter of devices by type, or None if the org has more devices
+            than fit in one page
+        
+        Raises:
+            Exception: If the listing call fails (so stale cache data is served
+                instead of zero counts)
+        """
+        # vc=true lists every Virtual Chassis member, matching countOrgInventory
+        response = self._call_once(
+            f"inventory:{target_org}",
+            lambda: _call_api(
+                mistapi.api.v1.orgs.inventory.getOrgInventory,
+                session, target_org,
+                vc='true',
+                limit=INVENTORY_PAGE_LIMIT
+            )
+        )
+        
+        if response.status_code != 200:
+            raise Exception(f"API error: {response.status_code}")
+        if not isinstance(response.data, list):
+            return None
+        
+        headers = response.headers or {}
+        try:
+            total = int(headers['X-Page-Total'])
+        except (KeyError, TypeError, ValueError):
+            # Without a usable total, a full page may be truncated
+            total = None
+        if total is None:
+            if len(response.data) >= INVENTORY_PAGE_LIMIT:
+                return None
+        elif total > len(response.data):
+            return None
+        
+        return Counter(device.get('type') for device in response.data)
+    
+    def _count_inventory_by_type(self, session: mistapi.APISession, target_org: str) -> Dict[str, int]:
+        """Count devices per type with one countOrgInventory call per type, issued concurrently"""
+        type_counts = {}
+        
+        # countOrgInventory returns the actual physical count (e.g., all members
+        # in a VC stack), which aligns with licensing requirements
+        with ThreadPoolExecutor(max_workers=len(INVENTORY_DEVICE_TYPES)) as executor:
+            # Identical counts requested concurrently (e.g. overlapping
+            # /api/compare calls) share a single upstream request
+            responses = executor.map(
+                lambda device_type: self._call_once(
+                    f"count:{target_org}:{device_type}",
+                    lambda: _call_api(
+                        mistapi.api.v1.orgs.inventory.countOrgInventory,
+                        session, target_org,
+                        type=device_type
+                    )
+                ),
+                INVENTORY_DEVICE_TYPES
+            )
+            
+            for device_type, count_response in zip(INVENTORY_DEVICE_TYPES, responses):
+                # A missing type must fail the call rather than be reported as zero
+                if count_response.status_code != 200:
+                    raise Exception(f"API error: {count_response.status_code}")
+                # Sum up counts from all models in the results
+                results = count_response.data.get('results', [])
+                type_counts[device_type] = sum(result.get('count', 0) for result in results)
+        
+        return type_counts
+    
+    @cached(ttl=INVENTORY_TTL, single_flight=True)
     def get_org_inventory_counts(self, org_id: Optional[str] = None) -> Dict:
         """
         Get inventory counts by device type (physical device counts for licensing)
@@ -237,33 +532,19 @@ class MistConnection:
         }
         
         try:
-            # Use countOrgInventory to get physical device counts
-            # This returns the actual physical count (e.g., all members in a VC stack)
-            # which aligns with licensing requirements
-            for device_type in ['ap', 'switch', 'gateway']:
-                count_response = mistapi.api.v1.orgs.inventory.countOrgInventory(
-                    session, target_org,
-                    type=device_type
-                )
-                
-                if count_response.status_code == 200:
-                    # Sum up counts from all models in the results
-                    total = 0
-                    results = count_response.data.get('results', [])
-                    for result in results:
-                        total += result.get('count', 0)
-                    
-                    if device_type == 'ap':
-                        counts['aps'] = total
-                    elif device_type == 'switch':
-                        counts['switches'] = total
-                    elif device_type == 'gateway':
-                        counts['gateways'] = total
+            # Small orgs: one inventory listing covers every device, counted locally.
+            # Larger orgs fall back to the per-type count endpoint.
+            type_counts = self._count_inventory_listing(session, target_org)
+            if type_counts is None:
+                type_counts = self._count_inventory_by_type(session, target_org)
+            
+            for device_type, key in INVENTORY_DEVICE_TYPES.items():
+                counts[key] = type_counts.get(device_type, 0)
             
             counts['total'] = counts['aps'] + counts['switches'] + counts['gateways']
             return counts
             
         except Exception as e:
-            logger.error(f"Error getting inventory counts for org {target_org}: {str(e)}")
+            logger.error("Error getting inventory counts for org %s: %s", target_org, e)
             raise
 